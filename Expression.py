@@ -1,130 +1,186 @@
 from __future__ import annotations
-from typing import List, Tuple, Type
-from Rational import Calculatable, Rational, is_digit
-from enum import Enum, auto
+from typing import Callable, List, NamedTuple, Tuple, Type
+from Rational import DIGITS, Calculatable, Rational
+from enum import Enum
+from functools import lru_cache
 import re
 
 
 # ignore commas and underscores
 IGNORE_REGEX = r"[,_]"
 
-
-def find_matching_parens(s: str, i: int) -> int:
-  level = 0
-  for j, char in enumerate(s[i + 1:], i + 1):
-    # print(j, char, level)
-    if char == "(":
-      level += 1
-    elif char == ")":
-      if level == 0:
-        return j
-      else:
-        level -= 1
-  raise ValueError("Couldn't find a matching parens!")
-
-
-def op(a: Rational, b: Rational, operation: Operation) -> Rational:
-    if operation == Operation.ADD:
-        return Rational.add(a, b)
-    elif operation == Operation.SUBTRACT:
-        return Rational.subtract(a, b)
-    elif operation == Operation.MULTIPLY:
-        return Rational.multiply(a, b)
-    elif operation == Operation.DIVIDE:
-        return Rational.divide(a, b)
-    elif operation == Operation.EXPONENT:
-        # this isn't necessarily rational, but whatever
-        return Rational(a.as_float() ** b.as_float())
-    raise ValueError("Invalid operation!")
+# characters that can make up a number literal
+NUMBER_CHARS = DIGITS | {"."}
 
 
 class Operation(Enum):
-    ADD = auto()
-    SUBTRACT = auto()
-    MULTIPLY = auto()
-    DIVIDE = auto()
-    EXPONENT = auto()
+    ADD = "+"
+    SUBTRACT = "-"
+    MULTIPLY = "*"
+    DIVIDE = "/"
+    EXPONENT = "^"
 
     def __str__(self: Operation) -> str:
-      if self == Operation.ADD:
-        return "+"
-      elif self == Operation.SUBTRACT:
-        return "-"
-      elif self == Operation.MULTIPLY:
-        return "*"
-      elif self == Operation.DIVIDE:
-        return "/"
-      elif self == Operation.EXPONENT:
-        return "^"
+      return self.value
 
     def __repr__(self) -> str:
-      return self.__str__()
+      return self.value
 
     @staticmethod
     def parse(x: str) -> Operation:
-      if x == "+":
-        return Operation.ADD
-      elif x == "-":
-        return Operation.SUBTRACT
-      elif x == "*":
-        return Operation.MULTIPLY
-      elif x == "/":
-        return Operation.DIVIDE
-      elif x == "^":
-        return Operation.EXPONENT
-
-
-class Token:
-
-  # switch this to from_operation, from_value, and from_expression
-  def __init__(self, operation: Operation = None, value: Calculatable = None, is_expression: bool = False):
-    if operation:
-      self.operation = operation
-      self.value = None
-    elif value:
-      self.value = value
-      self.operation = None
+      return Operation(x)
+
+
+# the characters that stand for an Operation
+SYMBOLS = frozenset(operation.value for operation in Operation)
+
+OPERATIONS = {
+  Operation.ADD: Rational.add,
+  Operation.SUBTRACT: Rational.subtract,
+  Operation.MULTIPLY: Rational.multiply,
+  Operation.DIVIDE: Rational.divide,
+  Operation.EXPONENT: Rational.power,
+}
+
+# how tightly each Operation binds, following PEMDAS
+PRECEDENCE = {
+  Operation.ADD: 1,
+  Operation.SUBTRACT: 1,
+  Operation.MULTIPLY: 2,
+  Operation.DIVIDE: 2,
+  Operation.EXPONENT: 3,
+}
+
+
+# the kinds of Token
+OPERATION = 0
+VALUE = 1
+
+
+class Token(NamedTuple):
+  kind: int
+  payload: Operation | Calculatable
 
   @staticmethod
-  def build_from(x: Operation | float | int | Rational | Expression) -> bool:
+  def from_operation(operation: Operation) -> Token:
+    return Token(OPERATION, operation)
+
+  @staticmethod
+  def from_value(value: Calculatable) -> Token:
+    return Token(VALUE, value)
+
+  @staticmethod
+  def build_from(x: Operation | float | int | Rational | Expression) -> Token:
     if isinstance(x, Operation):
-      return Token(operation=x)
-    elif isinstance(x, Rational):
-      return Token(value=x, is_expression=False)
-    elif isinstance(x, Expression):
-      return Token(value=x, is_expression=True)
+      return Token.from_operation(x)
+    elif isinstance(x, Rational) or isinstance(x, Expression):
+      return Token.from_value(x)
     elif isinstance(x, float) or isinstance(x, int):
-      return Token(value=Rational(x), is_expression=False)
+      return Token.from_value(Rational.parse(x))
+
+  @property
+  def operation(self) -> Operation | None:
+    return self.payload if self.kind == OPERATION else None
+
+  @property
+  def value(self) -> Calculatable | None:
+    return self.payload if self.kind == VALUE else None
 
   def is_operation(self) -> bool:
-    return self.operation is not None
+    return self.kind == OPERATION
 
   def is_value(self) -> bool:
-    return self.value is not None
+    return self.kind == VALUE
 
   def unwrap(self) -> Operation | Calculatable:
-    if self.is_operation():
-      return self.operation
-    elif self.is_value():
-      return self.value
+    return self.payload
 
-  def to_string(self, str=str) -> bool:
-    if self.is_operation():
-      return str(self.operation)
-    elif self.is_value():
-      return str(self.value)
+  def to_string(self, str=str) -> str:
+    return str(self.payload)
 
-  def __str__(self) -> bool:
+  def __str__(self) -> str:
     return self.to_string(str)
 
-  def __repr__(self) -> bool:
+  def __repr__(self) -> str:
     return self.to_string(repr)
 
 
+# the shape of an Expression: its Operations in order, with None for each literal and a nested Shape for each subexpression
+Shape = Tuple["Operation | Shape | None", ...]
+
+
+@lru_cache(maxsize=4096)
+def compile_shape(shape: Shape) -> Callable[[Tuple[Rational, ...]], Rational]:
+  """
+  Compiles an Expression shape into a Python function that calculates any Expression of that shape from its literals,
+  so that same-shape Expressions don't have to walk and dispatch on their Tokens. Every operation gets its own temporary
+  rather than nesting calls, and nested shapes are walked with an explicit stack, so arbitrarily long or deep
+  Expressions stay within the compiler's and interpreter's limits.
+  """
+
+  lines: List[str] = []
+  constants = 0
+
+  def apply(values: List[str], operations: List[Operation]) -> None:
+    b = values.pop()
+    a = values.pop()
+    name = "_t%i" % len(lines)
+    lines.append("  %s = _%s(%s, %s)" % (name, operations.pop().name.lower(), a, b))
+    values.append(name)
+
+  # one frame per (sub)expression being emitted: its remaining items, its operands and its pending operations
+  frames = [(iter(shape), [], [])]
+  while True:
+    items, values, operations = frames[-1]
+    # the same shunting-yard pass as calculating, emitting code instead of applying operations
+    for item in items:
+      if item is None:
+        values.append("_c[%i]" % constants)
+        constants += 1
+      elif isinstance(item, tuple):
+        frames.append((iter(item), [], []))
+        break
+      else:
+        precedence = PRECEDENCE[item]
+        # every operation is left-associative, so apply anything that binds at least as tightly
+        while len(operations) > 0 and PRECEDENCE[operations[-1]] >= precedence:
+          apply(values, operations)
+        operations.append(item)
+    else:
+      while len(operations) > 0:
+        apply(values, operations)
+      frames.pop()
+      if len(frames) == 0:
+        break
+      frames[-1][1].append(values[0])
+
+  source = "def _expression(_c):\n" + "\n".join(lines + ["  return " + values[0]]) + "\n"
+
+  namespace = {"_%s" % operation.name.lower(): function for operation, function in OPERATIONS.items()}
+  exec(compile(source, "<expression>", "exec"), namespace)
+  return namespace["_expression"]
+
+
+@lru_cache(maxsize=4096)
+def evaluate(signature: Tuple[Shape, Tuple[Rational, ...]]) -> Rational:
+  """Calculates an Expression signature with the compiled function for its shape, caching the result."""
+  shape, constants = signature
+  return compile_shape(shape)(constants)
+
+
 class Expression(Calculatable):
 
+  __slots__ = ("tokens", "_valid", "_expect_value")
+
   def __init__(self, *tokens: Tuple[Token]):
-    self.tokens: List[Token] = list(tokens)
+    self.tokens: List[Token] = []
+
+    # track value/operation alternation as Tokens are added, rather than rescanning them
+    self._valid = True
+    self._expect_value = True
+
+    for token in tokens:
+      self.add_token(token)
 
   @staticmethod
   def build_from(*tokens: Tuple[Operation | float | int | Rational | Expression]) -> Expression:
@@ -134,100 +190,95 @@ class Expression(Calculatable):
     return ex
 
   @staticmethod
-  def parse(s: str, indent: int = 0) -> Expression:
+  def parse(s: str) -> Expression:
     s = re.sub(IGNORE_REGEX, "", s)
-    # print("%sParsing '%s'" % ("\t" * indent, s))
     ex = Expression()
 
-    building_digit = False
-    working_digit = ""
+    # the Expressions enclosing the one currently being built, innermost last
+    enclosing: List[Expression] = []
+
+    n = len(s)
     i = 0
-    while i < len(s):
+    while i < n:
       char = s[i]
 
-      # print("\t%sChar at %i: '%s'" % ("\t" * indent, i, char))
-
-      if is_digit(char) or char == ".":
-        working_digit += char
-        building_digit = True
+      if char in NUMBER_CHARS:
+        # consume the whole number literal and parse it in one go
+        start = i
+        while i < n and s[i] in NUMBER_CHARS:
+          i += 1
+        x = Rational.parse(s[start:i])
+        ex.add_token(Token.from_value(x))
+        continue
+
+      # now worry about what else it is
+      if char in SYMBOLS:
+        # it's an operation
+        ex.add_token(Token.from_operation(Operation.parse(char)))
+      elif char == "(":
+
+        # allow writing things like '2(5-3)' and '(2-1)(3/4)'
+        if len(ex.tokens) > 0 and ex.tokens[-1].is_value():
+          ex.add_token(Token.from_operation(Operation.MULTIPLY))
+        enclosing.append(ex)
+        ex = Expression()
+      elif char == ")":
+        if len(enclosing) == 0:
+          raise ValueError("Couldn't find a matching parens!")
+        subex = ex
+        ex = enclosing.pop()
+        ex.add_token(Token.from_value(subex))
       else:
-        if building_digit:
-          x = Rational.parse(working_digit)
-          ex.add_token(Token(value=x))
-          building_digit = False
-          working_digit = ""
-
-        # now worry about what else it is
-        if char in ["+", "-", "*", "/", "^"]:
-          # it's an operation
-          ex.add_token(Token(operation=Operation.parse(char)))
-        elif char == "(":
-
-          # allow writing things like '2(5-3)' and '(2-1)(3/4)'
-          if len(ex.tokens) > 0 and ex.tokens[-1].is_value():
-            ex.add_token(Token(operation=Operation.MULTIPLY))
-          parens_location = find_matching_parens(s, i)
-          subex = Expression.parse(s[i+1:parens_location], indent + 1)
-          ex.add_token(Token(value=subex, is_expression=True))
-          i = parens_location
-        else:
-          raise ValueError("Couldn't parse an invalid Expression!")
+        raise ValueError("Couldn't parse an invalid Expression!")
       i += 1
-    if building_digit:
-      x = Rational.parse(working_digit)
-      ex.add_token(Token(value=x))
-    # print("%sParsed '%s' -> %s" % ("\t" * indent, s, str(ex)))
+    if len(enclosing) > 0:
+      raise ValueError("Couldn't find a matching parens!")
     return ex
 
   def add_token(self, token: Token) -> None:
     self.tokens.append(token)
+    self._valid = self._valid and token.is_value() is self._expect_value
+    self._expect_value = not self._expect_value
 
   def is_valid(self) -> bool:
-    on_value = True
-    for token in self.tokens:
-      if token.is_value() is not on_value:
-        return False
-      on_value = not on_value
-    return True
+    # a valid Expression alternates values and operations, and ends on a value
+    return self._valid and not self._expect_value
 
-  def calculate(self) -> Rational:
-    """Reduces this Expression's list of Tokens down to a single Rational Token."""
+  def signature(self) -> Tuple[Shape, Tuple[Rational, ...]]:
+    """
+    Returns a hashable snapshot of this Expression: its shape, and the values of its literals in order.
+    Nested Expressions are walked with an explicit stack rather than recursion, so deep nesting stays cheap.
+    """
 
     if not self.is_valid():
       raise Exception("Can't calculate an invalid expression!")
 
-    if len(self.tokens) == 1:
-      return self.tokens[0].value.calculate()
-
-    # PEMDAS
-    self.pemdas()
-
-    if not self.is_valid():
-      raise Exception("Something really went wrong!")
-
-    a = self.tokens[0].value.calculate()
-    b = self.tokens[2].value.calculate()
-    result = op(a, b, self.tokens[1].operation)
-
-    return result
-
-  def pemdas(self) -> None:
-    self.consolidate([Operation.EXPONENT])
-    self.consolidate([Operation.MULTIPLY, Operation.DIVIDE])
-    self.consolidate([Operation.ADD, Operation.SUBTRACT])
-
-  def consolidate(self, operations: List[Operation]) -> None:
-    """Consolidates this Expression and all of its subexpressions into 3 token expressions."""
-    i = 0
-    while i < len(self.tokens) and len(self.tokens) >= 4:
-      if self.tokens[i].is_operation() and self.tokens[i].operation in operations:
-        ex = Expression(self.tokens[i - 1], self.tokens[i], self.tokens[i + 1])
-        self.tokens = self.tokens[:i-1] + [Token(value=ex, is_expression=True)] + self.tokens[i+2:]
-
-        # restart consolidation
-        i = 0
-      i += 1
+    constants: List[Rational] = []
+
+    # one frame per Expression being snapshotted: its remaining Tokens and the shape built so far
+    frames = [(iter(self.tokens), [])]
+    while True:
+      tokens, shape = frames[-1]
+      for token in tokens:
+        if token.is_operation():
+          shape.append(token.operation)
+        elif token.value.is_expression():
+          if not token.value.is_valid():
+            raise Exception("Can't calculate an invalid expression!")
+          frames.append((iter(token.value.tokens), []))
+          break
+        else:
+          shape.append(None)
+          constants.append(token.value.calculate())
+      else:
+        frames.pop()
+        if len(frames) == 0:
+          return tuple(shape), tuple(constants)
+        frames[-1][1].append(tuple(shape))
 
+  def calculate(self) -> Rational:
+    """Reduces this Expression's list of Tokens down to a single Rational."""
+    return evaluate(self.signature())
 
   def is_expression(self) -> bool:
     return True
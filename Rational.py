@@ -1,16 +1,29 @@
 from __future__ import annotations
-from math import gcd, log10, ceil, floor
+from math import gcd, log2
+from functools import lru_cache
 from decimal import Decimal, InvalidOperation
 from typing import List, Sequence, Tuple, Type
 from abc import ABC, abstractmethod
+import sys
 
 def lcm(a: int, b: int) -> int:
     """Finds the least common multiple of any two integers."""
 
     return abs(a*b) // gcd(a, b)
 
+def power_of_ten_exponent(x: int) -> int | None:
+    """Returns n if a positive integer is 10^n (including 10^0 = 1), or None if it isn't a power of ten."""
+
+    n = 0
+    while x % 10 == 0:
+        x //= 10
+        n += 1
+    return n if x == 1 else None
+
 class Calculatable(ABC):
 
+    __slots__ = ()
+
     @abstractmethod
     def calculate(self) -> Rational:
         pass
@@ -24,102 +37,134 @@ class Calculatable(ABC):
         pass
 
 
+@lru_cache(maxsize=4096)
+def integer_ratio(s: str) -> Tuple[int, int]:
+    """Returns the numerator and denominator of a decimal string, cached since the same literals come up over and over."""
+
+    return Decimal(s).as_integer_ratio()
+
+
+DIGITS = frozenset("0123456789")
+
+# the largest result, in bits, that Rational.power will ever compute exactly before falling back to floats
+MAX_EXACT_POWER_BITS = 1 << 20
+
+
+def max_exact_power_bits() -> int:
+    """
+    Returns the largest result, in bits, that Rational.power should compute exactly. Anything longer than the
+    interpreter's int to str digit limit couldn't be printed, so it takes the float fallback instead.
+    """
+
+    # only Pythons with the limit have this, and 0 means it's disabled
+    digits = sys.get_int_max_str_digits() if hasattr(sys, "get_int_max_str_digits") else 0
+    if digits == 0:
+        return MAX_EXACT_POWER_BITS
+    return min(MAX_EXACT_POWER_BITS, int(digits * log2(10)))
+
+
 def is_digit(x: str) -> bool:
-    try:
-        int(x)
-        return True
-    except ValueError:
-        return False
+    return x in DIGITS
 
 
 class Rational(Calculatable):
-    """A class that represents a rational number."""
+    """A class that represents a rational number. Rationals are immutable and always kept in lowest terms."""
 
-    def __init__(self, numer: int, denom: int = 1, simplify: bool = True):
+    __slots__ = ("numer", "denom")
+
+    def __init__(self, numer: int, denom: int = 1):
         if denom == 0:
             raise ZeroDivisionError("The denominator must not be zero!")
 
+        # keep the sign on the numerator
+        if denom < 0:
+            numer = -numer
+            denom = -denom
+
+        # reduce to lowest terms once, here; nothing mutates a Rational afterwards
+        if denom != 1:
+            x = gcd(numer, denom)
+            numer //= x
+            denom //= x
+
         self.numer = numer
         self.denom = denom
 
-        if self.denom != 1 and simplify:
-            self.simplify()
-
     @staticmethod
-    def copy(rat: Rational, simplify: bool = True) -> Rational:
-        return Rational(rat.numer, rat.denom, simplify)
+    def copy(rat: Rational) -> Rational:
+        return Rational(rat.numer, rat.denom)
 
     @staticmethod
     def parse(s: Type[Decimal] | Type[float] | Type[str] | Type[Tuple[int, Sequence[int], int]]) -> Rational:
         try:
-            numer, denom = Decimal(s).as_integer_ratio()
-            return Rational(numer, denom, simplify=True)
+            if isinstance(s, str):
+                numer, denom = integer_ratio(s)
+            else:
+                numer, denom = Decimal(s).as_integer_ratio()
+            return Rational(numer, denom)
         except InvalidOperation:
             raise ValueError("Couldn't parse as a Rational!")
 
-    def simplify(self) -> None:
-        """Simplifies this Rational."""
-
-        x = gcd(int(self.numer), int(self.denom))
-        # print("simplifying", self.numer, self.denom, x)
-        self.numer = int(self.numer / x)
-        self.denom = int(self.denom / x)
-
-    def scale(self, x: int) -> None:
-        """Scales this Rational's numerator and denominator by x."""
-
-        if x == 0:
-            raise ZeroDivisionError("Cannot scale a Rational number by zero!")
+    @staticmethod
+    def _from_reduced(numer: int, denom: int) -> Rational:
+        """Builds a Rational that is already known to be in lowest terms with a positive denominator, skipping the gcd."""
 
-        self.numer *= x
-        self.denom *= x
+        rat = object.__new__(Rational)
+        rat.numer = numer
+        rat.denom = denom
+        return rat
 
     @staticmethod
     def reciprocal(x: Rational) -> Rational:
         """Returns the reciprocal of a Rational."""
 
-        if x.denom == 0:
+        if x.is_zero():
             raise ZeroDivisionError("Cannot take the reciprocal of zero!")
 
-        return Rational(x.denom, x.numer, False)
+        if x.numer < 0:
+            return Rational._from_reduced(-x.denom, -x.numer)
+        return Rational._from_reduced(x.denom, x.numer)
 
     @staticmethod
-    def match_denominators(a: Rational, b: Rational) -> int:
-        if a.denom != b.denom:
-            a_denom = a.denom
-            a.scale(b.denom)
-            b.scale(a_denom)
-        return a.denom
+    def multiply(a: Rational, b: Rational) -> Rational:
+        # cancel across the operands first, so the product is already in lowest terms
+        x = gcd(a.numer, b.denom)
+        y = gcd(b.numer, a.denom)
+        return Rational._from_reduced((a.numer // x) * (b.numer // y), (a.denom // y) * (b.denom // x))
 
     @staticmethod
-    def multiply(a: Rational, b: Rational, simplify: bool = True) -> Rational:
-        return Rational(int(a.numer * b.numer), int(a.denom * b.denom), simplify)
+    def divide(a: Rational, b: Rational) -> Rational:
+        return Rational.multiply(a, Rational.reciprocal(b))
 
     @staticmethod
-    def divide(a: Rational, b: Rational, simplify: bool = True) -> Rational:
-        return Rational.multiply(a, Rational.reciprocal(b), simplify)
+    def add(a: Rational, b: Rational) -> Rational:
+        numer = a.numer * b.denom + b.numer * a.denom
+        # the sum of two reduced fractions with coprime denominators is already reduced
+        if gcd(a.denom, b.denom) == 1:
+            return Rational._from_reduced(numer, a.denom * b.denom)
+        return Rational(numer, a.denom * b.denom)
 
     @staticmethod
-    def add(a: Rational, b: Rational, simplify: bool = True) -> Rational:
-        denom = Rational.match_denominators(a, b)
-
-        result = Rational(a.numer + b.numer, denom, simplify)
-
-        a.simplify()
-        b.simplify()
-
-        return result
+    def subtract(a: Rational, b: Rational) -> Rational:
+        numer = a.numer * b.denom - b.numer * a.denom
+        if gcd(a.denom, b.denom) == 1:
+            return Rational._from_reduced(numer, a.denom * b.denom)
+        return Rational(numer, a.denom * b.denom)
 
     @staticmethod
-    def subtract(a: Rational, b: Rational, simplify: bool = True) -> Rational:
-        denom = Rational.match_denominators(a, b)
+    def power(a: Rational, b: Rational) -> Rational:
+        # estimate the size of an exact result, so huge integer powers don't try to build enormous ints
+        bits = abs(b.numer) * log2(max(abs(a.numer), a.denom))
 
-        result = Rational(int(a.numer - b.numer), int(denom), simplify)
+        if b.denom == 1 and bits <= max_exact_power_bits():
+            # integer exponents stay exact, and powers of coprime terms are still coprime
+            if b.numer >= 0:
+                return Rational._from_reduced(a.numer ** b.numer, a.denom ** b.numer)
+            return Rational.reciprocal(Rational.power(a, Rational(-b.numer)))
 
-        a.simplify()
-        b.simplify()
-
-        return result
+        # this isn't necessarily rational, so parse the float result's shortest decimal form, which keeps a power of ten
+        # denominator and lets to_string print it as the same decimal
+        return Rational.parse(repr(a.as_float() ** b.as_float()))
 
     def is_positive(self) -> bool:
         return self.numer > 0 and self.denom > 0
@@ -132,23 +177,23 @@ class Rational(Calculatable):
 
     def as_egyptian_fraction(self) -> List[Rational]:
         """
-        Calculates the shortest Egyptian Fraction for this Rational. This algorithm is horrible, as it checks every possible integer.
-        For example, if the shortest Egyptian Fraction includes 1/x, this algorithm will check every integer up to and including x.
+        Calculates an Egyptian Fraction for this positive Rational with the greedy Fibonacci-Sylvester algorithm.
+        Each step takes the largest unit fraction 1/x that fits in what's left, i.e. x = ceil(denom / numer).
+        This always terminates, but the result isn't necessarily the shortest possible expansion.
         """
-        x = Rational.copy(self)
+        numer, denom = self.numer, self.denom
 
         result = []
 
-        i = 2
-        while not x.is_zero():
-            candidate = Rational(1, i)
-            y = Rational.subtract(x, candidate)
+        while numer > 0:
+            # ceil(denom / numer) without going through floats
+            i = -(-denom // numer)
+            result.append(Rational(1, i))
 
-            if not y.is_negative():
-                result.append(candidate)
-                x = y
-
-            i += 1
+            numer, denom = numer * i - denom, denom * i
+            x = gcd(numer, denom)
+            numer //= x
+            denom //= x
 
         return result
 
@@ -156,7 +201,12 @@ class Rational(Calculatable):
         return float(self.numer / self.denom)
 
     def to_string(self, float_only=False) -> str:
-        if float_only or (self.denom != 1 and ceil(log10(self.denom)) == floor(log10(self.denom))):
+        exponent = power_of_ten_exponent(self.denom)
+        if self.denom != 1 and exponent is not None:
+            # terminating decimals can be written out exactly, by shifting the numerator's decimal point
+            digits = Decimal(self.numer).as_tuple()._replace(exponent=-exponent)
+            return format(Decimal(digits), "f")
+        elif float_only:
             return str(self.numer / self.denom)
         else:
             return str(self)
@@ -173,14 +223,15 @@ class Rational(Calculatable):
         if not isinstance(o, Rational):
             return False
 
-        a = Rational.copy(self, simplify=True)
-        b = Rational.copy(o, simplify=True)
-
-        return a.numer == b.numer and a.denom == b.denom
+        return self.numer * o.denom == o.numer * self.denom
 
     def __ne__(self, o: object) -> bool:
         return not self.__eq__(o)
 
+    def __hash__(self) -> int:
+        # Rationals are always in lowest terms with a positive denominator, so equal values hash alike
+        return hash((self.numer, self.denom))
+
     def calculate(self) -> Rational:
         return self
 
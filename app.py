@@ -2,19 +2,15 @@
 
 from __future__ import annotations
 import sys
-from itertools import permutations
+from itertools import chain, permutations
 from enum import Enum, auto
 from Rational import Rational
-from Expression import Expression, Operation, Token, find_matching_parens
+from Expression import Expression, Operation, Token
 from argparse import ArgumentParser
 
 
 def get_permutations(numbers: list) -> set:
-    all = set()
-    for l in range(len(numbers)):
-        perm = set(permutations(numbers, l + 1))
-        all = all.union(perm)
-    return all
+    return set(chain.from_iterable(permutations(numbers, l + 1) for l in range(len(numbers))))
 
 
 def init_argparse() -> ArgumentParser: